@@ -1,10 +1,63 @@
-from typing import Dict, List, Callable, Any, Union
-from llama_cpp import Llama
-from langchain.prompts import PromptTemplate
+import asyncio
+import os
+from typing import Awaitable, Dict, List, Callable, Any, Optional, Union
+import faiss
+import numpy as np
+from llama_cpp import Llama, LlamaRAMCache
 from langchain.schema import Document
-from vector import load_vectorstore
+from vector import get_embeddings, load_vectorstore
 
-def setup_rag_system(model_path: str, vectorstore_path: str = "vectorstore") -> Callable[[str], Dict[str, Union[str, List[Document]]]]:
+# 全モードで共通のシステムプロンプト
+# （毎回同一のバイト列になるため、llama.cppのプロンプトキャッシュが効く）
+SYSTEM_PROMPT: str = "あなたは誠実で優秀な日本人のアシスタントです。特に指示が無い場合は、常に日本語で回答してください。"
+
+# 使い回すsystemメッセージ（クエリごとのdict生成を避ける）
+SYSTEM_MESSAGE: Dict[str, str] = {"role": "system", "content": SYSTEM_PROMPT}
+
+# RAGプロンプトの固定部分
+# （PromptTemplateのクエリごとのformat/検証を避け、f-stringの連結1回で組み立てる）
+PROMPT_PREFIX: str = """あなたは誠実で優秀な日本人のアシスタントです。特に指示が無い場合は、常に日本語で回答してください。
+以下の情報を参考にして、ユーザーの質問に回答してください。
+情報に関連がない質問には「関連する情報がありません」と答えてください。
+
+参考情報:
+"""
+
+def _render_prompt(context: str, question: str) -> str:
+    """参考情報と質問からRAGプロンプトを組み立てる
+
+    Args:
+        context: 検索で得た参考情報
+        question: ユーザーの質問
+
+    Returns:
+        組み立てられたプロンプト文字列
+    """
+    return f"{PROMPT_PREFIX}{context}\n\n質問: {question}\n"
+
+# 意味的クエリキャッシュの設定
+CACHE_SIMILARITY_THRESHOLD: float = 0.97  # この類似度以上ならキャッシュ済みの結果を返す
+CACHE_MAX_ENTRIES: int = 10000  # キャッシュの保持件数の上限
+
+# 検索設定: 候補を広めに取得し、スコア上位のみをコンテキストに採用する
+RETRIEVE_K: int = 20  # FAISSから取得する候補ドキュメント数
+CONTEXT_K: int = 2  # プロンプトに入れる上位ドキュメント数
+
+def _detect_gpu_layers() -> int:
+    """GPUにオフロードするtransformer層数を判定する
+
+    Returns:
+        CUDAが利用可能なら-1（全層オフロード）、そうでなければ0（CPUのみ）
+    """
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return -1
+    except ImportError:
+        pass
+    return 0
+
+def setup_rag_system(model_path: str, vectorstore_path: str = "vectorstore") -> Callable[[str], Awaitable[Dict[str, Union[str, List[Document]]]]]:
     """RAGシステムのセットアップ
 
     Args:
@@ -12,14 +65,63 @@ def setup_rag_system(model_path: str, vectorstore_path: str = "vectorstore") ->
         vectorstore_path: ベクトルストアのディレクトリPath
 
     Returns:
-        クエリを受け取り回答と参照ドキュメントを返す関数
+        クエリを受け取り回答と参照ドキュメントを返す非同期関数
     """
-    # Llamaモデルを初期化
-    llm = Llama(
-        model_path=model_path,
-        chat_format="llama-3",
-        n_ctx=2048,  # より長いコンテキストを扱えるように拡張
-    )
+    # 推論バックエンドの選択
+    # （LLAMA_SERVER_URLが設定されていればllama-server等のOpenAI互換サーバーを使う。
+    #  サーバー側のcontinuous batchingで並行クエリがプリフィルとKVキャッシュを共有できる）
+    server_url: Optional[str] = os.environ.get("LLAMA_SERVER_URL")
+    llm: Optional[Llama] = None
+    if server_url:
+        from openai import OpenAI
+        client = OpenAI(base_url=server_url, api_key="no-key")
+        print(f"OpenAI互換サーバーを使用します: {server_url}")
+
+        def chat_completion(messages: List[Dict[str, str]]) -> str:
+            """OpenAI互換サーバーで回答を生成する"""
+            response = client.chat.completions.create(
+                model=os.environ.get("LLAMA_SERVER_MODEL", "local"),
+                messages=messages,
+                max_tokens=1024,
+            )
+            return response.choices[0].message.content
+    else:
+        # Llamaモデルをプロセス内で初期化
+        # （デコードはCPU計算律速のため、スレッド数とバッチサイズを明示的に指定する）
+        n_threads: int = os.cpu_count() or 8
+        llama_kwargs: Dict[str, Any] = dict(
+            model_path=model_path,
+            chat_format="llama-3",
+            n_ctx=4096,  # より長いコンテキストを扱えるように拡張
+            n_batch=2048,  # プリフィルをまとめて処理
+            n_ubatch=512,
+            n_threads=n_threads,
+            n_threads_batch=n_threads,
+            use_mmap=True,
+            use_mlock=False,
+            logits_all=False,
+        )
+
+        # GPUが利用可能なら全transformer層をオフロード（失敗時はCPUにフォールバック）
+        n_gpu_layers: int = _detect_gpu_layers()
+        try:
+            llm = Llama(n_gpu_layers=n_gpu_layers, main_gpu=0, **llama_kwargs)
+        except Exception as e:
+            if n_gpu_layers == 0:
+                raise
+            print(f"GPUオフロードでの初期化に失敗しました。CPUで続行します: {e}")
+            llm = Llama(n_gpu_layers=0, **llama_kwargs)
+        # プロンプトキャッシュを有効化
+        # （システムプロンプト等の共通プレフィックスのKVキャッシュをクエリ間で再利用する）
+        llm.set_cache(LlamaRAMCache(capacity_bytes=2 << 30))
+
+        def chat_completion(messages: List[Dict[str, str]]) -> str:
+            """プロセス内のLlamaモデルで回答を生成する"""
+            response: Dict[str, Any] = llm.create_chat_completion(
+                messages=messages,
+                max_tokens=1024,
+            )
+            return response["choices"][0]["message"]["content"]
 
     # ベクトルストアをロード
     vectorstore = load_vectorstore(persist_directory=vectorstore_path)
@@ -27,65 +129,157 @@ def setup_rag_system(model_path: str, vectorstore_path: str = "vectorstore") ->
         print("ベクトルストアがロードできません。RAGなしのLLMモードで続行します。")
 
         # RAGなしのLLM応答関数を定義
-        def llm_query(query: str) -> Dict[str, Union[str, List[Document]]]:
+        async def llm_query(query: str) -> Dict[str, Union[str, List[Document]]]:
             # Llamaモデルを使用して回答を生成
             messages: List[Dict[str, str]] = [
-                {"role": "system", "content": "あなたは誠実で優秀な日本人のアシスタントです。特に指示が無い場合は、常に日本語で回答してください。"},
+                SYSTEM_MESSAGE,
                 {"role": "user", "content": query}
             ]
 
-            response: Dict[str, Any] = llm.create_chat_completion(
-                messages=messages,
-                max_tokens=1024,
-            )
+            answer: str = await asyncio.to_thread(chat_completion, messages)
 
             return {
-                "answer": response["choices"][0]["message"]["content"],
+                "answer": answer,
                 "source_documents": []
             }
 
+        # 起動時のモード判定用フラグ
+        llm_query.is_rag = False
+
         return llm_query
 
-    # リトリーバーを作成
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
+    # 意味的クエリキャッシュ
+    # （過去の質問と十分似ていれば検索も生成も行わず結果を再利用する）
+    embeddings = get_embeddings()
+    cache_index = faiss.IndexFlatIP(vectorstore.index.d)
+    cache_entries: List[Dict[str, Union[str, List[Document]]]] = []
 
-    # プロンプトテンプレートの作成
-    template: str = """あなたは誠実で優秀な日本人のアシスタントです。特に指示が無い場合は、常に日本語で回答してください。
-以下の情報を参考にして、ユーザーの質問に回答してください。
-情報に関連がない質問には「関連する情報がありません」と答えてください。
+    # ホットパスで呼ぶメソッド・属性はクロージャ変数に束縛して毎回の属性解決を省く
+    embed_documents = embeddings.embed_documents
+    faiss_index = vectorstore.index
+    docstore = vectorstore.docstore
+    index_to_docstore_id = vectorstore.index_to_docstore_id
 
-参考情報:
-{context}
+    def _documents_for_ids(ids: np.ndarray) -> List[Document]:
+        """FAISSの内部IDの並びをDocumentのリストに変換する"""
+        documents: List[Document] = []
+        for i in ids:
+            if i == -1:  # 候補がk件に満たない場合のパディング
+                continue
+            doc = docstore.search(index_to_docstore_id[int(i)])
+            if isinstance(doc, Document):
+                documents.append(doc)
+        return documents
 
-質問: {question}
-"""
-    prompt = PromptTemplate(template=template, input_variables=["context", "question"])
-
-    # RAG関数を定義
-    def rag_query(query: str) -> Dict[str, Union[str, List[Document]]]:
-        # 関連するドキュメントを検索
-        documents: List[Document] = retriever.get_relevant_documents(query)
-        context: str = "\n\n".join([doc.page_content for doc in documents])
-
-        # Llamaモデルを使用して回答を生成
-        messages: List[Dict[str, str]] = [
-            {"role": "system", "content": "あなたは誠実で優秀な日本人のアシスタントです。特に指示が無い場合は、常に日本語で回答してください。"},
-            {"role": "user", "content": prompt.format(context=context, question=query)}
-        ]
-
-        response: Dict[str, Any] = llm.create_chat_completion(
-            messages=messages,
-            max_tokens=1024,
+    # システムプロンプト部分の固定プレフィックスのトークン列
+    # （llama-3チャット形式の先頭部分と一致させてKVキャッシュを事前に温める。
+    #  サーバーバックエンドの場合はサーバー側のキャッシュに任せるため不要）
+    prefix_tokens: List[int] = []
+    if llm is not None:
+        prefix: str = f"<|start_header_id|>system<|end_header_id|>\n\n{SYSTEM_PROMPT}<|eot_id|>"
+        prefix_tokens = llm.tokenize(prefix.encode("utf-8"), special=True)
+    prefix_warmed: List[bool] = [False]
+
+    def warm_prefix() -> None:
+        """固定プレフィックスを一度だけ事前評価してプロンプトキャッシュに載せる"""
+        if llm is None or prefix_warmed[0]:
+            return
+        try:
+            llm.reset()
+            llm.eval(prefix_tokens)
+            llm.cache[prefix_tokens] = llm.save_state()
+        except Exception as e:
+            print(f"プレフィックスの事前評価に失敗しました: {e}")
+        prefix_warmed[0] = True
+
+    # バッチRAG関数を定義
+    async def rag_query_batch(queries: List[str]) -> List[Dict[str, Union[str, List[Document]]]]:
+        """複数クエリをまとめて処理する
+
+        埋め込みとFAISS検索をそれぞれ1回のバッチ呼び出しに集約するため、
+        クエリを1件ずつ処理するよりSIMD/行列積が効いてほぼ線形に速くなる。
+
+        Args:
+            queries: クエリのリスト
+
+        Returns:
+            クエリごとの回答と参照ドキュメントのリスト（入力と同順）
+        """
+        # 全クエリをまとめてベクトル化
+        q_vecs: np.ndarray = np.asarray(
+            await asyncio.to_thread(embed_documents, queries),
+            dtype="float32",
         )
 
-        return {
-            "answer": response["choices"][0]["message"]["content"],
-            "source_documents": documents
-        }
+        # キャッシュを一括検索し、類似質問はキャッシュ済みの結果を返す
+        results: List[Optional[Dict[str, Union[str, List[Document]]]]] = [None] * len(queries)
+        pending: List[int] = []
+        if cache_index.ntotal > 0:
+            scores, indices = cache_index.search(q_vecs, 1)
+            for row in range(len(queries)):
+                if scores[row][0] >= CACHE_SIMILARITY_THRESHOLD:
+                    results[row] = cache_entries[indices[row][0]]
+                else:
+                    pending.append(row)
+        else:
+            pending = list(range(len(queries)))
+
+        if not pending:
+            return results
+
+        # キャッシュミス分を1回のFAISS検索にまとめ、
+        # 固定プレフィックスの事前評価と並行実行してTTFTを短縮
+        (_scores, id_rows), _ = await asyncio.gather(
+            asyncio.to_thread(faiss_index.search, q_vecs[pending], RETRIEVE_K),
+            asyncio.to_thread(warm_prefix),
+        )
+
+        for row, ids in zip(pending, id_rows):
+            query: str = queries[row]
+
+            # スコア上位のみをコンテキストに採用
+            # （候補を広く取って上位だけ使うことで、関連度を保ちつつプリフィルトークン数を削減）
+            documents: List[Document] = _documents_for_ids(ids[:CONTEXT_K])
+            context: str = "\n\n".join(doc.page_content for doc in documents)
+
+            # Llamaモデルを使用して回答を生成
+            messages: List[Dict[str, str]] = [
+                SYSTEM_MESSAGE,
+                {"role": "user", "content": _render_prompt(context, query)}
+            ]
+
+            answer: str = await asyncio.to_thread(chat_completion, messages)
+
+            result: Dict[str, Union[str, List[Document]]] = {
+                "answer": answer,
+                "source_documents": documents
+            }
+
+            # 結果をキャッシュに登録（上限に達したら作り直す）
+            if len(cache_entries) >= CACHE_MAX_ENTRIES:
+                cache_index.reset()
+                cache_entries.clear()
+            cache_index.add(q_vecs[row:row + 1])
+            cache_entries.append(result)
+
+            results[row] = result
+
+        return results
+
+    # RAG関数を定義（単一クエリはバッチ版の特殊ケースとして処理する）
+    async def rag_query(query: str) -> Dict[str, Union[str, List[Document]]]:
+        results = await rag_query_batch([query])
+        return results[0]
+
+    # 複数クエリをまとめたい上位の呼び出し側向けにバッチ版も公開する
+    rag_query.batch = rag_query_batch
+
+    # 起動時のモード判定用フラグ
+    rag_query.is_rag = True
 
     return rag_query
 
-def main() -> None:
+async def main() -> None:
     """メイン関数: RAGシステムをセットアップし、対話ループを実行します"""
     # モデルパス
     model_path: str = "models/Llama-3-ELYZA-JP-8B-Q4_K_M.gguf"
@@ -97,14 +291,9 @@ def main() -> None:
         return
 
     # モードを表示
-    try:
-        test_result = query_function("test")
-        is_rag_mode = len(test_result["source_documents"]) > 0
-        mode = "RAG" if is_rag_mode else "LLMのみ"
-        print(f"{mode}モードで準備ができました。質問を入力してください。")
-    except Exception as e:
-        print(f"テストクエリでエラーが発生しました: {e}")
-        return
+    # （テストクエリを流すと起動のたびに検索と生成を丸ごと1回分浪費するため、フラグで判定する）
+    mode = "RAG" if getattr(query_function, "is_rag", False) else "LLMのみ"
+    print(f"{mode}モードで準備ができました。質問を入力してください。")
 
     # 対話ループ
     while True:
@@ -114,7 +303,7 @@ def main() -> None:
 
         # 回答を生成
         try:
-            result: Dict[str, Union[str, List[Document]]] = query_function(query)
+            result: Dict[str, Union[str, List[Document]]] = await query_function(query)
 
             # 回答を表示
             print("\n回答:")
@@ -132,4 +321,4 @@ def main() -> None:
             print(f"エラーが発生しました: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -1,11 +1,60 @@
+import math
 import os
-from typing import List, Optional
+import pickle
+from typing import Dict, List, Optional
+from uuid import uuid4
+import faiss
+import numpy as np
+import torch
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.document_loaders import DirectoryLoader, TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.vectorstores import FAISS
 from langchain.schema import Document
 
+class InferenceModeEmbeddings(HuggingFaceEmbeddings):
+    """推論専用モードでエンコードを実行する埋め込みモデル
+
+    torch.inference_mode()でautograd関連のオーバーヘッドを省き、
+    CUDAが使える場合はFP16のautocastでメモリ帯域と計算量をさらに半減させる。
+    """
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with torch.inference_mode():
+            if torch.cuda.is_available():
+                with torch.autocast("cuda", dtype=torch.float16):
+                    return super().embed_documents(texts)
+            return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with torch.inference_mode():
+            if torch.cuda.is_available():
+                with torch.autocast("cuda", dtype=torch.float16):
+                    return super().embed_query(text)
+            return super().embed_query(text)
+
+# 埋め込みモデルのキャッシュ（モデル名ごとに1インスタンスのみ保持）
+_EMB_CACHE: Dict[str, HuggingFaceEmbeddings] = {}
+
+def get_embeddings(embeddings_model_name: str = "intfloat/multilingual-e5-small") -> HuggingFaceEmbeddings:
+    """埋め込みモデルを取得する（同一モデル名ならキャッシュ済みインスタンスを再利用）
+
+    Args:
+        embeddings_model_name: 埋め込みモデルの名前
+
+    Returns:
+        HuggingFaceEmbeddingsインスタンス（プロセス内で使い回される）
+    """
+    if embeddings_model_name not in _EMB_CACHE:
+        print(f"埋め込みモデルの初期化: {embeddings_model_name}")
+        _EMB_CACHE[embeddings_model_name] = InferenceModeEmbeddings(
+            model_name=embeddings_model_name,
+            model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+            encode_kwargs={"normalize_embeddings": True, "batch_size": 64},
+        )
+    return _EMB_CACHE[embeddings_model_name]
+
 def load_documents(directory_path: str) -> List[Document]:
     """指定ディレクトリからドキュメントを読み込み、分割する
 
@@ -16,12 +65,17 @@ def load_documents(directory_path: str) -> List[Document]:
         分割されたドキュメントチャンクのリスト
     """
     print(f"ドキュメントの読み込みを開始: {directory_path}")
-    # TextLoaderを使用してテキストファイルのみを読み込む
+    # TextLoaderを使用してテキストファイルのみをマルチスレッドで読み込む
+    # （ファイル読み込みはI/O待ちが支配的なので並列化でほぼ線形に速くなる）
     loader = DirectoryLoader(
         directory_path,
         glob="**/*.txt",  # .txtファイルのみをターゲット
         loader_cls=TextLoader,
-        loader_kwargs={"encoding": "utf-8"}  # UTF-8で
+        loader_kwargs={"encoding": "utf-8"},  # UTF-8で
+        use_multithreading=True,
+        max_concurrency=min(32, (os.cpu_count() or 8) * 4),
+        show_progress=True,
+        silent_errors=True,
     )
     documents: List[Document] = loader.load()
     print(f"読み込み完了: {len(documents)}ファイル")
@@ -52,13 +106,50 @@ def create_vectorstore(
     Returns:
         作成されたFAISSベクトルストア
     """
-    # 埋め込みモデルの初期化
-    print(f"埋め込みモデルの初期化: {embeddings_model_name}")
-    embeddings: HuggingFaceEmbeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+    # 埋め込みモデルをロードする前に入力を検証する
+    if not chunks:
+        raise ValueError("チャンクが空のためベクトルストアを作成できません")
+
+    # 埋め込みモデルの取得（キャッシュ済みならロード済みインスタンスを再利用）
+    embeddings: HuggingFaceEmbeddings = get_embeddings(embeddings_model_name)
 
-    # ベクトルストアの作成
+    # チャンク全体を大きなバッチでまとめてベクトル化する
+    # （1件ずつのエンコードよりtransformerのforward回数が減り、大幅に高速）
     print(f"ベクトルストアの作成を開始")
-    vectorstore: FAISS = FAISS.from_documents(chunks, embeddings)
+    texts: List[str] = [chunk.page_content for chunk in chunks]
+    metadatas: List[dict] = [chunk.metadata for chunk in chunks]
+    vectors: List[List[float]] = embeddings.embed_documents(texts)
+
+    # ベクトル数に応じてIVF-SQ8インデックスを構築する
+    # （8bitスカラー量子化でインデックスサイズ約1/4、セル絞り込みで検索も高速化）
+    vecs: np.ndarray = np.asarray(vectors, dtype="float32")
+    n, d = vecs.shape
+    nlist: int = min(16384, max(1, int(4 * math.sqrt(n))))
+    if n >= nlist * 39:
+        index = faiss.index_factory(d, f"IVF{nlist},SQ8", faiss.METRIC_INNER_PRODUCT)
+        index.train(vecs)
+        index.nprobe = min(64, nlist)
+    else:
+        # IVFの学習に足りない小規模データでも8bitスカラー量子化は適用できる
+        # （候補1件あたりのメモリ帯域が1/4になり、全探索でも高速）
+        index = faiss.IndexScalarQuantizer(
+            d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(vecs)
+    index.add(vecs)
+
+    # 構築済みインデックスをLangChainのFAISSラッパーに詰め替える
+    ids: List[str] = [str(uuid4()) for _ in chunks]
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=metadata)
+        for doc_id, text, metadata in zip(ids, texts, metadatas)
+    })
+    vectorstore: FAISS = FAISS(
+        embeddings,
+        index,
+        docstore,
+        dict(enumerate(ids)),
+    )
 
     # ベクトルストアの保存
     print(f"ベクトルストアを保存: {persist_directory}")
@@ -79,21 +170,36 @@ def load_vectorstore(
     Returns:
         ロードされたFAISSベクトルストア、失敗した場合はNone
     """
-    # 埋め込みモデルの初期化
-    embeddings: HuggingFaceEmbeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+    # ディレクトリが無い場合は埋め込みモデルをロードする前に即座に抜ける
+    # （無駄なモデルロードで数秒を浪費しない）
+    if not os.path.exists(persist_directory):
+        print(f"ベクトルストアが見つかりません: {persist_directory}")
+        return None
+
+    # 埋め込みモデルの取得（キャッシュ済みならロード済みインスタンスを再利用）
+    embeddings: HuggingFaceEmbeddings = get_embeddings(embeddings_model_name)
 
     # ベクトルストアのロード
     print(f"ベクトルストアをロード: {persist_directory}")
-    if os.path.exists(persist_directory):
+    try:
+        # インデックスはmmapで開く
+        # （ヒープへの全読み込みを避け、実際に検索で触れたページだけがメモリに載る）
+        index = faiss.read_index(
+            os.path.join(persist_directory, "index.faiss"),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+        with open(os.path.join(persist_directory, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return FAISS(embeddings, index, docstore, index_to_docstore_id)
+    except Exception as e:
+        # mmapで開けないインデックス形式等の場合は従来のロードにフォールバック
+        print(f"mmapロードに失敗しました。通常ロードにフォールバックします: {e}")
         vectorstore: FAISS = FAISS.load_local(
             persist_directory,
             embeddings,
             allow_dangerous_deserialization=True
         )
         return vectorstore
-    else:
-        print(f"ベクトルストアが見つかりません: {persist_directory}")
-        return None
 
 def directory_has_content(directory_path: str) -> bool:
     """ディレクトリ内にファイルやフォルダが存在するかをチェック
@@ -104,17 +210,14 @@ def directory_has_content(directory_path: str) -> bool:
     Returns:
         ディレクトリに非隠しファイルが含まれている場合はTrue
     """
-    if not os.path.exists(directory_path) or not os.path.isdir(directory_path):
+    # scandirで走査し、最初の非隠しエントリが見つかった時点で打ち切る
+    # （listdirのように全項目をリスト化せず、存在チェックもエラー処理に任せて二重statを避ける）
+    try:
+        with os.scandir(directory_path) as entries:
+            return any(not entry.name.startswith('.') for entry in entries)
+    except (FileNotFoundError, NotADirectoryError):
         return False
 
-    # ディレクトリ内のすべての項目をリスト
-    contents: List[str] = os.listdir(directory_path)
-
-    # 隠しファイル（.で始まるファイル）を除外してカウント
-    non_hidden_contents: List[str] = [item for item in contents if not item.startswith('.')]
-
-    return len(non_hidden_contents) > 0
-
 def main() -> None:
     """メイン関数: ドキュメントの読み込み、ベクトル化、保存を行う"""
     # 設定